@@ -0,0 +1,253 @@
+"""
+Shared helpers for the Keycloak admin scripts.
+
+Used by fix-keycloak-client.py, setup-keycloak-multitenant.py and the
+setup-keycloak-all.py driver. Everything stateful lives here — the
+keep-alive connections, the admin token and the role/user id caches — so
+scripts run in the same process share it.
+"""
+import atexit
+import base64
+import http.client
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+# orjson is optional — it serializes straight to bytes and parses faster
+try:
+    import orjson
+    dumps, loads = orjson.dumps, orjson.loads
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj).encode()
+    loads = json.loads
+
+KC = 'http://localhost:8080'
+REALM = 'crm-prod'
+# Survives across processes, so separate script runs share the token too.
+# Kept in a per-user directory, not the shared /tmp.
+TOKEN_CACHE = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser('~/.cache'),
+                           'kc_admin_token.json')
+
+# ── HTTP ─────────────────────────────────────────────────────────────────────
+
+_IDEMPOTENT = {'GET', 'HEAD', 'PUT', 'DELETE'}
+
+# Each thread keeps one keep-alive connection and reuses it for every call
+# instead of opening a fresh socket per request (http.client connections are
+# not thread-safe, so the pool workers can't share one).
+_local = threading.local()
+_conns = []
+# Shared pool for independent admin calls; its workers keep their connections
+# across batches
+POOL = ThreadPoolExecutor(4)
+
+def _connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = http.client.HTTPConnection(urlsplit(KC).netloc, timeout=15)
+        _conns.append(conn)
+    return conn
+
+def request(method, path, body=None, headers=None):
+    """Send a raw request over this thread's connection.
+
+    Returns (status, body bytes, response headers).
+    """
+    conn = _connection()
+    for attempt in range(2):
+        reused, sent = conn.sock is not None, False
+        try:
+            conn.request(method, path, body, headers or {})
+            sent = True
+            resp = conn.getresponse()
+            return resp.status, resp.read(), resp.headers
+        except (http.client.HTTPException, ConnectionError) as e:
+            # Close the connection so a retry reconnects
+            conn.close()
+            # Retry only what can't be applied twice: idempotent methods, or a
+            # kept-alive connection the server had already dropped (the send
+            # failed, or it closed without answering)
+            stale = reused and (not sent or isinstance(e, http.client.RemoteDisconnected))
+            if attempt or not (method in _IDEMPOTENT or stale):
+                raise
+
+@atexit.register
+def close():
+    POOL.shutdown()
+    for conn in _conns:
+        conn.close()
+
+def api(method, path, data=None, token=None):
+    if token in _superseded:
+        token = admin_token()
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    body = dumps(data) if data else None
+    code, content, _ = request(method, path, body, headers)
+    if code == 401 and token and (token == _admin_token.get('token') or token in _superseded):
+        # The admin token was rejected (e.g. Keycloak was recreated while the
+        # cached one was still unexpired) — retry once with a new one. Another
+        # thread may already have renewed it, hence the _superseded check.
+        headers['Authorization'] = f'Bearer {_renew_admin_token(token)}'
+        code, content, _ = request(method, path, body, headers)
+    if code >= 400:
+        return code, content.decode()
+    return code, loads(content) if content else None
+
+# ── Tokens ───────────────────────────────────────────────────────────────────
+
+def password_grant(client_id, username, password, realm=REALM):
+    """Run a password grant and return the raw token response body."""
+    body = urlencode({'grant_type': 'password', 'client_id': client_id,
+                      'username': username, 'password': password}).encode()
+    code, content, _ = request('POST', f'/realms/{realm}/protocol/openid-connect/token', body,
+                               {'Content-Type': 'application/x-www-form-urlencoded'})
+    if code != 200:
+        raise RuntimeError(f'{username} token request failed: {code} {content.decode()}')
+    return content
+
+_admin_token = {}
+# Admin tokens Keycloak has rejected; callers may still hold them, so api()
+# swaps them for the current one
+_superseded = set()
+_renew_lock = threading.Lock()
+
+def admin_token():
+    """Master-realm admin token, reused while it has >30s left.
+
+    Checked in memory first, then in TOKEN_CACHE, before doing a new grant.
+    """
+    if _admin_token and time.time() < _admin_token['exp'] - 30:
+        return _admin_token['token']
+    try:
+        with open(TOKEN_CACHE) as f:
+            cached = json.load(f)
+        if cached['kc'] == KC and time.time() < cached['exp'] - 30:
+            _admin_token.update(cached)
+            return cached['token']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    resp = loads(password_grant('admin-cli', 'admin', 'admin', realm='master'))
+    _admin_token.update({'kc': KC, 'token': resp['access_token'],
+                         'exp': time.time() + resp['expires_in']})
+
+    _save_token_cache()
+    return resp['access_token']
+
+def _renew_admin_token(rejected):
+    """Drop a rejected admin token from memory and TOKEN_CACHE and grant anew.
+
+    Concurrent callers holding the same token share a single new grant: only
+    the first one renews, the rest get the token it obtained.
+    """
+    with _renew_lock:
+        if _admin_token.get('token') == rejected:
+            _superseded.add(rejected)
+            _admin_token.clear()
+            try:
+                os.remove(TOKEN_CACHE)
+            except OSError:
+                pass
+        return admin_token()
+
+def _save_token_cache():
+    """Best-effort write of the admin token to TOKEN_CACHE.
+
+    mkstemp creates a fresh 0600 file (never following an existing path),
+    which is then swapped in atomically. Failing to cache is not an error.
+    """
+    tmp = None
+    try:
+        cache_dir = os.path.dirname(TOKEN_CACHE)
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.kc_admin_token.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_admin_token, f)
+        os.replace(tmp, TOKEN_CACHE)
+    except OSError:
+        if tmp:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+def access_token(content):
+    """Slice access_token out of a raw token response without parsing the body.
+
+    JWTs are base64url segments joined by dots, so the value never contains a
+    quote or escape. Falls back to a full JSON parse if the field isn't
+    serialized compactly.
+    """
+    _, found, rest = content.partition(b'"access_token":"')
+    if found:
+        return rest.partition(b'"')[0].decode()
+    return loads(content)['access_token']
+
+def decode_jwt_payload(tok):
+    """Decode the (unverified) claims segment of a JWT.
+
+    JWTs use the URL-safe base64 alphabet without padding.
+    """
+    payload = tok.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    return loads(base64.urlsafe_b64decode(payload))
+
+# ── Roles & users ────────────────────────────────────────────────────────────
+
+_roles = None
+_user_ids = {}
+
+def realm_roles(refresh=False):
+    """Realm role name → id, listed once per process.
+
+    Pass refresh=True after creating roles; drop deleted roles from the
+    returned dict so every caller sees the change.
+    """
+    global _roles
+    if _roles is None or refresh:
+        code, roles = api('GET', f'/admin/realms/{REALM}/roles', token=admin_token())
+        if code != 200:
+            raise RuntimeError(f'Listing realm roles failed: {code} {roles}')
+        _roles = {r['name']: r['id'] for r in roles}
+    return _roles
+
+def role_id(name):
+    """Id of a realm role, or None if it doesn't exist."""
+    return realm_roles().get(name)
+
+def user_id(username):
+    """Id of the user with this exact username, or None (memoized)."""
+    if username not in _user_ids:
+        code, users = api('GET', f'/admin/realms/{REALM}/users?username={username}&exact=true',
+                          token=admin_token())
+        if code != 200:
+            raise RuntimeError(f'Looking up user {username} failed: {code} {users}')
+        _user_ids[username] = users[0]['id'] if users else None
+    return _user_ids[username]
+
+def get_user(uid):
+    """Current representation of a user, fetched fresh (not cached) so it can
+    be modified and PUT back."""
+    code, user = api('GET', f'/admin/realms/{REALM}/users/{uid}', token=admin_token())
+    if code != 200:
+        raise RuntimeError(f'Fetching user {uid} failed: {code} {user}')
+    return user
+
+def map_roles(uid, add=(), remove=(), token=None):
+    """Add/remove realm roles for a user with one POST and at most one DELETE.
+
+    Keycloak takes an array of role representations, so every role for the
+    user goes in the same request. Returns the POST status.
+    """
+    path = f'/admin/realms/{REALM}/users/{uid}/role-mappings/realm'
+    if remove:
+        api('DELETE', path, data=[{'id': role_id(r), 'name': r} for r in remove], token=token)
+    code, _ = api('POST', path, data=[{'id': role_id(r), 'name': r} for r in add], token=token)
+    return code
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Run fix-keycloak-client.py and then setup-keycloak-multitenant.py in one
+process, so both flows share kc_admin's connections, admin token and
+role/user caches instead of starting cold. Command-line arguments (e.g.
+--verify) are setup-keycloak-multitenant.py's; they are parsed before any
+flow runs.
+"""
+import importlib.util
+import logging
+import sys
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+HERE = Path(__file__).resolve().parent
+FLOWS = ['fix-keycloak-client', 'setup-keycloak-multitenant']
+
+def load(name):
+    # Script file names contain dashes, so they can't be imported by name
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), HERE / f'{name}.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def main(argv=None):
+    """Run each flow in order, stopping at the first one that fails."""
+    flows = {name: load(name) for name in FLOWS}
+    setup = flows['setup-keycloak-multitenant']
+    # Reject bad arguments (and handle --help) before anything is changed
+    args = setup.parse_args(argv)
+    for name, module in flows.items():
+        log.info(f'\n▶ {name}.py')
+        status = module.main(args) if module is setup else module.main()
+        if status:
+            log.info(f'\n❌ {name}.py failed (exit {status}), stopping')
+            return status
+    return 0
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+    sys.exit(main())